@@ -1,7 +1,11 @@
 import streamlit as st
 import pandas as pd
+import hashlib
 import json
-from omr_processor import OMRProcessor
+import os
+from concurrent.futures import ThreadPoolExecutor
+from omr_processor import OMRProcessor, answer_key_to_array
+from models import Database, OMRResult, json_dumps
 
 st.set_page_config(layout="wide")
 st.title("🎯 OMR Evaluation for Hackathon")
@@ -10,6 +14,21 @@ st.title("🎯 OMR Evaluation for Hackathon")
 def get_processor():
     return OMRProcessor(debug=st.session_state.get('debug_mode', True))
 
+@st.cache_resource
+def get_database():
+    return Database()
+
+# Results for at most this many sheets are kept; with debug mode on each one
+# carries its annotated image (a few MB), so the cache must not grow per upload
+SHEET_CACHE_ENTRIES = 64
+
+@st.cache_data(show_spinner=False, max_entries=SHEET_CACHE_ENTRIES)
+def process_sheet_cached(_processor, image_bytes: bytes, answer_key_arr, debug: bool):
+    # Keyed on the raw bytes, the flattened key and the debug flag (the processor
+    # itself is not hashed), so reruns and re-clicks reuse earlier results
+    # instead of decoding the sheet again
+    return _processor.process_omr_sheet(image_bytes, answer_key_arr)
+
 def main():
     if 'debug_mode' not in st.session_state: st.session_state.debug_mode = True
     processor = get_processor()
@@ -26,24 +45,65 @@ def main():
     if uploaded_key:
         try:
             st.session_state.answer_key = {str(k): v for k, v in json.load(uploaded_key).items()}
+            # Flatten once so every sheet is scored against the same ndarray
+            st.session_state.answer_key_arr = answer_key_to_array(st.session_state.answer_key)
             st.sidebar.success(f"{len(st.session_state.answer_key)} questions loaded.")
         except Exception: st.sidebar.error("Invalid JSON key file.")
     
-    if st.sidebar.button("🚀 Process OMR Sheets", disabled=not (uploaded_files and 'answer_key' in st.session_state)):
+    if st.sidebar.button("🚀 Process OMR Sheets", disabled=not (uploaded_files and 'answer_key_arr' in st.session_state)):
         st.session_state.results = []
-        for uploaded_file in uploaded_files:
-            with st.spinner(f"Processing {uploaded_file.name}..."):
-                image_bytes = uploaded_file.getvalue()
-                result = processor.process_omr_sheet(image_bytes, st.session_state.answer_key)
-                
-                if result and result.get('error') is None:
-                    result['filename'] = uploaded_file.name
-                    st.session_state.results.append(result)
-                    st.success(f"{uploaded_file.name}: Score = {result.get('percentage', 0):.2f}%")
-                    if processor.debug and processor.processed_image_for_debug is not None:
-                        st.image(processor.processed_image_for_debug, caption=f"Debug: {uploaded_file.name}")
-                else:
-                    st.error(f"Failed to process {uploaded_file.name}: {result.get('error', 'Unknown')}")
+        answer_key = st.session_state.answer_key_arr
+
+        sheet_version = os.path.splitext(uploaded_key.name)[0] if uploaded_key else "unknown"
+        saved_sheets = st.session_state.setdefault('saved_sheets', set())
+
+        def work(name, image_bytes):
+            digest = hashlib.sha1(image_bytes).hexdigest()
+            return name, digest, process_sheet_cached(processor, image_bytes, answer_key, processor.debug)
+
+        # OpenCV releases the GIL, so sheets can be processed in parallel threads
+        max_workers = os.cpu_count() or 1
+        new_results = []
+        with st.spinner(f"Processing {len(uploaded_files)} sheet(s)..."):
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                futures = [executor.submit(work, f.name, f.getvalue()) for f in uploaded_files]
+                # Collect in upload order so messages and the results table keep the
+                # order the sheets were uploaded in, whichever finishes first
+                for future in futures:
+                    name, digest, result = future.result()
+                    if result and result.get('error') is None:
+                        result['filename'] = name
+                        st.session_state.results.append(result)
+                        # Re-clicking Process must not store the same sheet twice
+                        sheet_id = (name, sheet_version, digest)
+                        if sheet_id not in saved_sheets:
+                            saved_sheets.add(sheet_id)
+                            new_results.append(result)
+                        st.success(f"{name}: Score = {result.get('percentage', 0):.2f}%")
+                        debug_image = result.pop('debug_image', None)
+                        if debug_image is not None:
+                            st.image(debug_image, channels="BGR", caption=f"Debug: {name}")
+                    else:
+                        st.error(f"Failed to process {name}: {result.get('error', 'Unknown')}")
+
+        # Persist the new sheets in one transaction instead of one commit per sheet
+        if new_results:
+            get_database().save_results([
+                OMRResult(
+                    filename=r['filename'],
+                    sheet_version=sheet_version,
+                    total_questions=r['total_questions'],
+                    correct_answers=r['correct'],
+                    percentage=r['percentage'],
+                    subject_scores=json_dumps(r['subject_scores']),
+                    detailed_results=json_dumps({
+                        str(q): {'marked': m, 'answer': int(k), 'status': 'correct' if m == k else 'incorrect'}
+                        for q, (m, k) in enumerate(zip(r['marked'], answer_key), start=1) if k >= 0
+                    }),
+                    processing_info=json_dumps({'debug_mode': processor.debug})
+                )
+                for r in new_results
+            ])
 
     if 'results' in st.session_state and st.session_state.results:
         st.header("📊 Results")
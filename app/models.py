@@ -7,10 +7,35 @@ Handles data storage and retrieval using SQLite
 
 import sqlite3
 import json
+import threading
+import numpy as np
 from datetime import datetime
-from typing import Dict, List, Optional
+from typing import Dict, Iterable, Iterator, List, Optional, Union
 from dataclasses import dataclass
 import logging
+from collections import Counter
+
+try:
+    import orjson
+
+    json_loads = orjson.loads
+
+    def json_dumps(obj) -> str:
+        # OPT_NON_STR_KEYS keeps json.dumps' behaviour of stringifying int keys
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode()
+
+    def json_dumps_indented(obj) -> str:
+        # Two-space indent with non-ASCII left as UTF-8, like the fallback below;
+        # also serializes numpy values, but writes NaN/Infinity as null where json
+        # writes NaN/Infinity, and its float text can differ (1e16 vs 1e+16)
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS
+                            | orjson.OPT_SERIALIZE_NUMPY).decode()
+except ImportError:  # orjson is a declared dependency; stdlib json covers installs without it
+    json_loads = json.loads
+    json_dumps = json.dumps
+
+    def json_dumps_indented(obj) -> str:
+        return json.dumps(obj, indent=2, ensure_ascii=False)
 
 logger = logging.getLogger(__name__)
 
@@ -38,12 +63,29 @@ class Database:
     def __init__(self, db_path: str = "omr_results.db"):
         """Initialize database connection"""
         self.db_path = db_path
+        # One connection for the lifetime of the manager, shared across threads
+        # and serialized by the lock; autocommit unless a method opens a transaction
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(self.db_path, isolation_level=None, check_same_thread=False)
+        self.conn.executescript("""
+            PRAGMA journal_mode=WAL;
+            PRAGMA synchronous=NORMAL;
+            PRAGMA cache_size=-100000;
+            PRAGMA temp_store=MEMORY;
+            PRAGMA mmap_size=268435456;
+        """)
         self.create_tables()
     
+    def close(self):
+        """Close the database connection"""
+        with self.lock:
+            self.conn.close()
+    
     def create_tables(self):
         """Create necessary database tables"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self.lock:
+                conn = self.conn
                 cursor = conn.cursor()
                 
                 # Create results table
@@ -63,6 +105,21 @@ class Database:
                     )
                 """)
                 
+                # Indices for ordered retrieval and the analytics queries; the
+                # (processed_at, percentage) one covers the trend query outright
+                cursor.execute("""
+                    CREATE INDEX IF NOT EXISTS idx_results_created
+                    ON omr_results(created_at DESC)
+                """)
+                cursor.execute("""
+                    CREATE INDEX IF NOT EXISTS idx_results_processed
+                    ON omr_results(processed_at, percentage)
+                """)
+                cursor.execute("""
+                    CREATE INDEX IF NOT EXISTS idx_results_percentage
+                    ON omr_results(percentage)
+                """)
+                
                 # Create answer_keys table
                 cursor.execute("""
                     CREATE TABLE IF NOT EXISTS answer_keys (
@@ -84,7 +141,6 @@ class Database:
                     )
                 """)
                 
-                conn.commit()
                 logger.info("Database tables created successfully")
                 
         except Exception as e:
@@ -94,7 +150,8 @@ class Database:
     def save_result(self, result: OMRResult) -> int:
         """Save OMR processing result to database"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self.lock:
+                conn = self.conn
                 cursor = conn.cursor()
                 
                 cursor.execute("""
@@ -115,7 +172,6 @@ class Database:
                 ))
                 
                 result_id = cursor.lastrowid
-                conn.commit()
                 
                 logger.info(f"Result saved with ID: {result_id}")
                 return result_id
@@ -124,10 +180,50 @@ class Database:
             logger.error(f"Error saving result: {e}")
             raise
     
+    def save_results(self, results: List[OMRResult]) -> int:
+        """Save a batch of OMR results in a single transaction"""
+        rows = [(
+            result.filename,
+            result.sheet_version,
+            result.total_questions,
+            result.correct_answers,
+            result.percentage,
+            result.subject_scores,
+            result.detailed_results,
+            result.processing_info,
+            result.processed_at
+        ) for result in results]
+        
+        try:
+            with self.lock:
+                conn = self.conn
+                cursor = conn.cursor()
+                
+                cursor.execute("BEGIN")
+                try:
+                    cursor.executemany("""
+                        INSERT INTO omr_results (
+                            filename, sheet_version, total_questions, correct_answers,
+                            percentage, subject_scores, detailed_results, processing_info, processed_at
+                        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                    """, rows)
+                    cursor.execute("COMMIT")
+                except Exception:
+                    cursor.execute("ROLLBACK")
+                    raise
+                
+                logger.info(f"Saved {len(rows)} results")
+                return len(rows)
+                
+        except Exception as e:
+            logger.error(f"Error saving results: {e}")
+            raise
+    
     def get_result(self, result_id: int) -> Optional[OMRResult]:
         """Retrieve a specific result by ID"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self.lock:
+                conn = self.conn
                 cursor = conn.cursor()
                 
                 cursor.execute("SELECT * FROM omr_results WHERE id = ?", (result_id,))
@@ -155,7 +251,8 @@ class Database:
     def get_all_results(self) -> List[OMRResult]:
         """Retrieve all results from database"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self.lock:
+                conn = self.conn
                 cursor = conn.cursor()
                 
                 cursor.execute("""
@@ -188,15 +285,15 @@ class Database:
     def save_answer_key(self, version: str, answer_key: Dict) -> bool:
         """Save answer key to database"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self.lock:
+                conn = self.conn
                 cursor = conn.cursor()
                 
                 cursor.execute("""
                     INSERT OR REPLACE INTO answer_keys (version, answer_key)
                     VALUES (?, ?)
-                """, (version, json.dumps(answer_key)))
+                """, (version, json_dumps(answer_key)))
                 
-                conn.commit()
                 logger.info(f"Answer key saved for version: {version}")
                 return True
                 
@@ -207,7 +304,8 @@ class Database:
     def get_answer_key(self, version: str) -> Optional[Dict]:
         """Retrieve answer key for specific version"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self.lock:
+                conn = self.conn
                 cursor = conn.cursor()
                 
                 cursor.execute(
@@ -217,7 +315,8 @@ class Database:
                 row = cursor.fetchone()
                 
                 if row:
-                    return json.loads(row[0])
+                    # JSON object keys are strings; hand back the int question numbers that were saved
+                    return {int(q): a for q, a in json_loads(row[0]).items()}
                 return None
                 
         except Exception as e:
@@ -227,7 +326,8 @@ class Database:
     def get_database_stats(self) -> Dict:
         """Get database statistics"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self.lock:
+                conn = self.conn
                 cursor = conn.cursor()
                 
                 # Count total results
@@ -264,11 +364,11 @@ class Database:
     def clear_all_results(self) -> bool:
         """Clear all results from database"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self.lock:
+                conn = self.conn
                 cursor = conn.cursor()
                 
                 cursor.execute("DELETE FROM omr_results")
-                conn.commit()
                 
                 logger.info("All results cleared from database")
                 return True
@@ -280,7 +380,8 @@ class Database:
     def save_setting(self, key: str, value: str) -> bool:
         """Save application setting"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self.lock:
+                conn = self.conn
                 cursor = conn.cursor()
                 
                 cursor.execute("""
@@ -288,7 +389,6 @@ class Database:
                     VALUES (?, ?, ?)
                 """, (key, value, datetime.now().isoformat()))
                 
-                conn.commit()
                 return True
                 
         except Exception as e:
@@ -298,7 +398,8 @@ class Database:
     def get_setting(self, key: str, default: str = None) -> Optional[str]:
         """Retrieve application setting"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self.lock:
+                conn = self.conn
                 cursor = conn.cursor()
                 
                 cursor.execute("SELECT value FROM settings WHERE key = ?", (key,))
@@ -310,6 +411,119 @@ class Database:
             logger.error(f"Error retrieving setting: {e}")
             return default
 
+    def iter_results_for_csv(self, batch_size: int = 1000) -> Iterator[tuple]:
+        """Yield the CSV export columns of every result without materializing them"""
+        try:
+            with self.lock:
+                cursor = self.conn.cursor()
+                cursor.execute("""
+                    SELECT id, filename, sheet_version, total_questions,
+                           correct_answers, percentage, processed_at
+                    FROM omr_results
+                    ORDER BY created_at DESC
+                """)
+            
+            while True:
+                # Only hold the lock while fetching, never across a yield
+                with self.lock:
+                    rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                yield from rows
+                
+        except Exception as e:
+            # Re-raise: stopping quietly would leave the caller a truncated export
+            logger.error(f"Error streaming results: {e}")
+            raise
+    
+    def get_summary_stats(self) -> Dict:
+        """Aggregate score statistics and distribution in SQL"""
+        try:
+            with self.lock:
+                conn = self.conn
+                cursor = conn.cursor()
+                
+                cursor.execute("""
+                    SELECT
+                        COUNT(*),
+                        AVG(percentage),
+                        MIN(percentage),
+                        MAX(percentage),
+                        AVG(percentage * percentage),
+                        SUM(CASE WHEN percentage >= 90 THEN 1 ELSE 0 END),
+                        SUM(CASE WHEN percentage >= 80 AND percentage < 90 THEN 1 ELSE 0 END),
+                        SUM(CASE WHEN percentage >= 70 AND percentage < 80 THEN 1 ELSE 0 END),
+                        SUM(CASE WHEN percentage >= 60 AND percentage < 70 THEN 1 ELSE 0 END),
+                        SUM(CASE WHEN percentage >= 50 AND percentage < 60 THEN 1 ELSE 0 END),
+                        SUM(CASE WHEN percentage < 50 THEN 1 ELSE 0 END)
+                    FROM omr_results
+                """)
+                row = cursor.fetchone()
+                count = row[0]
+                
+                if count == 0:
+                    return {'total_sheets': 0}
+                
+                # Upper median, the same element sorted(scores)[n // 2] picks
+                cursor.execute("""
+                    SELECT percentage FROM omr_results
+                    ORDER BY percentage
+                    LIMIT 1 OFFSET ?
+                """, (count // 2,))
+                median = cursor.fetchone()[0]
+                
+                mean = row[1]
+                variance = max(row[4] - mean * mean, 0.0) if count >= 2 else 0.0
+                
+                return {
+                    'total_sheets': count,
+                    'average_score': mean,
+                    'median_score': median,
+                    'max_score': row[3],
+                    'min_score': row[2],
+                    'std_deviation': variance ** 0.5,
+                    'distribution': {
+                        '90-100%': row[5],
+                        '80-89%': row[6],
+                        '70-79%': row[7],
+                        '60-69%': row[8],
+                        '50-59%': row[9],
+                        'Below 50%': row[10]
+                    }
+                }
+                
+        except Exception as e:
+            logger.error(f"Error getting summary stats: {e}")
+            return {}
+    
+    def get_scores_by_processed_at(self) -> List[float]:
+        """Retrieve all percentages in processing order"""
+        try:
+            with self.lock:
+                conn = self.conn
+                cursor = conn.cursor()
+                
+                cursor.execute("SELECT percentage FROM omr_results ORDER BY processed_at")
+                return [row[0] for row in cursor.fetchall()]
+                
+        except Exception as e:
+            logger.error(f"Error retrieving scores: {e}")
+            return []
+    
+    def get_subject_scores(self) -> List[str]:
+        """Retrieve the subject_scores JSON of every result"""
+        try:
+            with self.lock:
+                conn = self.conn
+                cursor = conn.cursor()
+                
+                cursor.execute("SELECT subject_scores FROM omr_results")
+                return [row[0] for row in cursor.fetchall()]
+                
+        except Exception as e:
+            logger.error(f"Error retrieving subject scores: {e}")
+            return []
+
 class AnalyticsEngine:
     """Analytics engine for OMR results"""
     
@@ -318,108 +532,48 @@ class AnalyticsEngine:
     
     def generate_performance_report(self) -> Dict:
         """Generate comprehensive performance report"""
-        results = self.db.get_all_results()
+        stats = self.db.get_summary_stats()
         
-        if not results:
+        if not stats.get('total_sheets'):
             return {'error': 'No data available'}
         
-        # Basic statistics
-        scores = [result.percentage for result in results]
+        distribution = stats.pop('distribution')
         
         report = {
-            'summary': {
-                'total_sheets': len(results),
-                'average_score': sum(scores) / len(scores),
-                'median_score': sorted(scores)[len(scores) // 2],
-                'max_score': max(scores),
-                'min_score': min(scores),
-                'std_deviation': self._calculate_std(scores)
-            },
-            'distribution': self._analyze_score_distribution(scores),
-            'trends': self._analyze_trends(results),
-            'subject_analysis': self._analyze_subjects(results)
+            'summary': stats,
+            'distribution': distribution,
+            'trends': self._analyze_trends(self.db.get_scores_by_processed_at()),
+            'subject_analysis': self._analyze_subjects(self.db.get_subject_scores())
         }
         
         return report
     
-    def _calculate_std(self, scores: List[float]) -> float:
-        """Calculate standard deviation"""
+    def _analyze_trends(self, scores: List[float]) -> Dict:
+        """Analyze performance trends over time (scores in processing order)"""
         if len(scores) < 2:
-            return 0.0
-            
-        mean = sum(scores) / len(scores)
-        variance = sum((score - mean) ** 2 for score in scores) / len(scores)
-        return variance ** 0.5
-    
-    def _analyze_score_distribution(self, scores: List[float]) -> Dict:
-        """Analyze score distribution"""
-        ranges = {
-            '90-100%': 0,
-            '80-89%': 0,
-            '70-79%': 0,
-            '60-69%': 0,
-            '50-59%': 0,
-            'Below 50%': 0
-        }
-        
-        for score in scores:
-            if score >= 90:
-                ranges['90-100%'] += 1
-            elif score >= 80:
-                ranges['80-89%'] += 1
-            elif score >= 70:
-                ranges['70-79%'] += 1
-            elif score >= 60:
-                ranges['60-69%'] += 1
-            elif score >= 50:
-                ranges['50-59%'] += 1
-            else:
-                ranges['Below 50%'] += 1
-        
-        return ranges
-    
-    def _analyze_trends(self, results: List[OMRResult]) -> Dict:
-        """Analyze performance trends over time"""
-        # Sort by processing date
-        sorted_results = sorted(results, key=lambda x: x.processed_at)
-        
-        if len(sorted_results) < 2:
             return {'trend': 'insufficient_data'}
         
-        # Calculate trend (simple linear trend)
-        scores = [r.percentage for r in sorted_results]
-        n = len(scores)
-        
-        # Linear regression slope calculation
-        x_vals = list(range(n))
-        x_mean = sum(x_vals) / n
-        y_mean = sum(scores) / n
-        
-        numerator = sum((x - x_mean) * (y - y_mean) for x, y in zip(x_vals, scores))
-        denominator = sum((x - x_mean) ** 2 for x in x_vals)
-        
-        if denominator == 0:
-            slope = 0
-        else:
-            slope = numerator / denominator
+        # Calculate trend (simple least-squares linear fit)
+        arr = np.asarray(scores, dtype=np.float64)
+        slope = float(np.polyfit(np.arange(len(arr)), arr, 1)[0])
         
         trend_direction = 'improving' if slope > 0.1 else 'declining' if slope < -0.1 else 'stable'
         
         return {
             'trend': trend_direction,
             'slope': slope,
-            'first_score': scores[0],
-            'last_score': scores[-1],
-            'improvement': scores[-1] - scores[0]
+            'first_score': float(arr[0]),
+            'last_score': float(arr[-1]),
+            'improvement': float(arr[-1] - arr[0])
         }
     
-    def _analyze_subjects(self, results: List[OMRResult]) -> Dict:
+    def _analyze_subjects(self, subject_scores: List[str]) -> Dict:
         """Analyze subject-wise performance"""
         subject_data = {}
         
-        for result in results:
+        for raw in subject_scores:
             try:
-                subjects = json.loads(result.subject_scores)
+                subjects = json_loads(raw)
                 for subject, scores in subjects.items():
                     if subject not in subject_data:
                         subject_data[subject] = []
@@ -440,8 +594,8 @@ class AnalyticsEngine:
         return subject_analysis
 
 # Utility functions for data export
-def export_results_to_csv(results: List[OMRResult]) -> str:
-    """Export results to CSV format"""
+def export_results_to_csv(results: Union[Database, Iterable[OMRResult]]) -> str:
+    """Export results to CSV format, streaming rows straight from a Database if given one"""
     import csv
     import io
     
@@ -454,12 +608,21 @@ def export_results_to_csv(results: List[OMRResult]) -> str:
         'Correct Answers', 'Percentage', 'Processed At'
     ])
     
+    if isinstance(results, Database):
+        rows = results.iter_results_for_csv()
+    else:
+        rows = (
+            (result.id, result.filename, result.sheet_version,
+             result.total_questions, result.correct_answers,
+             result.percentage, result.processed_at)
+            for result in results
+        )
+    
     # Write data
-    for result in results:
+    for (result_id, filename, sheet_version, total, correct, percentage, processed_at) in rows:
         writer.writerow([
-            result.id, result.filename, result.sheet_version,
-            result.total_questions, result.correct_answers,
-            f"{result.percentage:.2f}%", result.processed_at
+            result_id, filename, sheet_version, total, correct,
+            f"{percentage:.2f}%", processed_at
         ])
     
     return output.getvalue()
@@ -483,8 +646,8 @@ def export_detailed_results(results: List[OMRResult]) -> str:
     # Write data
     for result in results:
         try:
-            subjects = json.loads(result.subject_scores)
-            detailed = json.loads(result.detailed_results)
+            subjects = json_loads(result.subject_scores)
+            detailed = json_loads(result.detailed_results)
             
             subject_scores = []
             for i in range(1, 6):
@@ -494,10 +657,11 @@ def export_detailed_results(results: List[OMRResult]) -> str:
                 else:
                     subject_scores.append('N/A')
             
-            # Calculate stats from detailed results
-            incorrect = sum(1 for q in detailed.values() if q['status'] == 'incorrect')
-            not_attempted = sum(1 for q in detailed.values() if q['status'] == 'not_attempted')
-            multiple_marked = sum(1 for q in detailed.values() if q['status'] == 'multiple_marked')
+            # Calculate stats from detailed results in a single pass
+            statuses = Counter(q['status'] for q in detailed.values())
+            incorrect = statuses['incorrect']
+            not_attempted = statuses['not_attempted']
+            multiple_marked = statuses['multiple_marked']
             
             writer.writerow([
                 result.id, result.filename, result.sheet_version,
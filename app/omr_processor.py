@@ -1,77 +1,244 @@
 # HYPER-TUNED omr_processor.py
+import io
 import cv2
 import numpy as np
-import imutils
+from PIL import Image
+
+ROWS = 20
+BLOCKS = 5
+OPTIONS_PER_QUESTION = 4
+# Sheets are processed with their longest edge capped at this many pixels;
+# the bubble size filters below are tuned for this working resolution
+MAX_IMAGE_EDGE = 1200
+# Accepted bubble size range, relative to the median candidate size
+BUBBLE_SIZE_BAND = (0.7, 1.3)
+# Accepted bubble width/height range; bubbles are round, question-number digits are not
+BUBBLE_ASPECT_BAND = (0.8, 1.25)
+# A bubble fits the grid if its centre is within this fraction of the radius of
+# the line fitted through its row and the one through its column; sheets with
+# more than GRID_MAX_MISFIT of bubbles off them are rejected
+GRID_FIT_TOLERANCE = 0.5
+GRID_MAX_MISFIT = 0.02
+
+def answer_key_to_array(answer_key: dict, total_questions: int = 100) -> np.ndarray:
+    """Flatten an answer key into an int8 array of option indices (-1 = missing)"""
+    key_arr = np.full(total_questions, -1, dtype=np.int8)
+    for question_num, answer in answer_key.items():
+        q = int(question_num)
+        if 1 <= q <= total_questions and answer is not None:
+            key_arr[q - 1] = answer
+    return key_arr
+
+def create_sample_answer_key(total_questions: int = 100, seed=None) -> dict:
+    """Random answer key {question number: option index} for demos and tests"""
+    rng = np.random.default_rng(seed)
+    answers = rng.integers(0, OPTIONS_PER_QUESTION, total_questions)
+    return {q: int(a) for q, a in enumerate(answers, start=1)}
+
+def validate_answer_key(answer_key: dict, total_questions: int = 100) -> bool:
+    """True if every question number is 1..total_questions and every answer a valid option index"""
+    for question_num, answer in answer_key.items():
+        try:
+            q = int(question_num)
+        except (TypeError, ValueError):
+            return False
+        if not 1 <= q <= total_questions:
+            return False
+        if not isinstance(answer, int) or isinstance(answer, bool) or not 0 <= answer < OPTIONS_PER_QUESTION:
+            return False
+    return True
+
+# Leading bytes searched for the image size; a header beyond this (e.g. behind a
+# very large EXIF block) just means no decode-time reduction
+HEADER_SNIFF_BYTES = 1 << 17
+_REDUCED_GRAYSCALE_FLAGS = (
+    (8, cv2.IMREAD_REDUCED_GRAYSCALE_8),
+    (4, cv2.IMREAD_REDUCED_GRAYSCALE_4),
+    (2, cv2.IMREAD_REDUCED_GRAYSCALE_2),
+)
+
+def _reduced_grayscale_flag(image_bytes) -> int:
+    """Pick the largest decode-time reduction that keeps the sheet at or above MAX_IMAGE_EDGE"""
+    try:
+        # Only the header is parsed here, from a copy of the leading bytes; the
+        # pixels are decoded by OpenCV
+        prefix = memoryview(image_bytes).cast('B')[:HEADER_SNIFF_BYTES]
+        with Image.open(io.BytesIO(prefix)) as header:
+            longest = max(header.size)
+    except Exception:
+        return cv2.IMREAD_GRAYSCALE
+    for factor, flag in _REDUCED_GRAYSCALE_FLAGS:
+        if longest // factor >= MAX_IMAGE_EDGE:
+            return flag
+    return cv2.IMREAD_GRAYSCALE
+
+def _row_angle(cx: np.ndarray, cy: np.ndarray, chunk: int = 512) -> float:
+    """Median direction, in radians, from each bubble centre to its nearest neighbour on the right
+
+    Neighbours within 45 degrees of horizontal are the next option in the same
+    row, so the median is the sheet's rotation. Distances are computed for
+    chunk centres at a time to bound memory on cluttered images.
+    """
+    cx = cx.astype(np.float32)
+    cy = cy.astype(np.float32)
+    angles = []
+    for start in range(0, len(cx), chunk):
+        dx = cx[None, :] - cx[start:start + chunk, None]
+        dy = cy[None, :] - cy[start:start + chunk, None]
+        dist = np.where((dx > 0) & (np.abs(dy) < dx), dx * dx + dy * dy, np.inf)
+        nearest = dist.argmin(axis=1)
+        rows = np.arange(len(nearest))
+        found = np.isfinite(dist[rows, nearest])
+        angles.append(np.arctan2(dy[rows, nearest], dx[rows, nearest])[found])
+    angles = np.concatenate(angles)
+    return float(np.median(angles)) if angles.size else 0.0
+
+def _line_residuals(t: np.ndarray, v: np.ndarray, axis: int) -> np.ndarray:
+    """Distance of each v from the least-squares line v = a + b * t fitted along axis"""
+    t = t - t.mean(axis=axis, keepdims=True)
+    v = v - v.mean(axis=axis, keepdims=True)
+    slope = (t * v).sum(axis=axis, keepdims=True) / np.maximum((t * t).sum(axis=axis, keepdims=True), 1e-9)
+    return np.abs(v - slope * t)
 
 class OMRProcessor:
     def __init__(self, debug=False):
         self.debug = debug
-        self.processed_image_for_debug = None
+        self.original_image = None
+
+    def load_image_from_bytes(self, image_bytes) -> bool:
+        """Decode an encoded sheet (bytes or any buffer, e.g. a memoryview) into self.original_image"""
+        image = cv2.imdecode(np.frombuffer(image_bytes, np.uint8), cv2.IMREAD_COLOR)
+        if image is None:
+            return False
+        self.original_image = image
+        return True
+
+    def load_image_from_array(self, image: np.ndarray) -> bool:
+        """Use an already decoded sheet as self.original_image, without a codec round-trip"""
+        self.original_image = np.ascontiguousarray(image)
+        return True
 
-    def process_omr_sheet(self, image_bytes, answer_key: dict):
+    def process_omr_sheet(self, image, answer_key):
+        """Score a sheet against an answer key dict or a pre-built answer_key_to_array() array
+
+        image is either the encoded file (bytes or a bytes-like buffer such as a
+        memoryview) or an already decoded BGR/grayscale array, so callers that
+        enhance sheets in memory skip a re-encode.
+        """
         try:
-            nparr = np.frombuffer(image_bytes, np.uint8)
-            image = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-            if image is None: return {'error': 'Failed to decode image.'}
+            if isinstance(image, np.ndarray):
+                gray = image if image.ndim == 2 else cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+            else:
+                nparr = np.frombuffer(image, np.uint8)
+                # Decode straight to grayscale, letting libjpeg scale by 1/2, 1/4 or 1/8
+                # in the DCT domain when the sheet is far above the working resolution
+                gray = cv2.imdecode(nparr, _reduced_grayscale_flag(image))
+            if gray is None: return {'error': 'Failed to decode image.'}
 
-            gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+            # Downscale the rest of the way before any per-pixel work
+            h, w = gray.shape[:2]
+            scale = MAX_IMAGE_EDGE / float(max(h, w))
+            if scale < 1:
+                gray = cv2.resize(gray, (int(w * scale), int(h * scale)), interpolation=cv2.INTER_AREA)
             
-            # Use adaptive thresholding, a powerful technique for uneven lighting
-            thresh = cv2.adaptiveThreshold(gray, 255,
+            # Use adaptive thresholding, a powerful technique for uneven lighting.
+            # maxValue=1 gives a 0/1 map, so window sums below are pixel counts
+            thresh = cv2.adaptiveThreshold(gray, 1,
                 cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY_INV, 21, 10)
 
-            # Find contours on the thresholded image
-            contours = cv2.findContours(thresh.copy(), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-            contours = imutils.grab_contours(contours)
-            
-            question_cnts = []
-            for c in contours:
-                (x, y, w, h) = cv2.boundingRect(c)
-                ar = w / float(h)
-                # EXTREMELY lenient parameters to find anything that looks like a bubble
-                if w >= 10 and h >= 10 and 0.5 <= ar <= 1.5:
-                    # Further check if the contour is somewhat circular
-                    if cv2.contourArea(c) > 50:
-                        question_cnts.append(c)
-
-            if len(question_cnts) < 400:
-                return {'error': f'Bubble detection failed (found {len(question_cnts)}). The sample images are not compatible with this CV approach.'}
-
-            # Sort contours from top-to-bottom
-            question_cnts = imutils.contours.sort_contours(question_cnts, method="top-to-bottom")[0]
-            
-            correct = 0
+            # Label blobs on the thresholded image; bboxes and areas come back as arrays
+            _, _, stats, _ = cv2.connectedComponentsWithStats(thresh, connectivity=8)
+            stats = stats[1:]  # drop the background component
+            xs = stats[:, cv2.CC_STAT_LEFT]
+            ys = stats[:, cv2.CC_STAT_TOP]
+            ws = stats[:, cv2.CC_STAT_WIDTH]
+            hs = stats[:, cv2.CC_STAT_HEIGHT]
+            areas = stats[:, cv2.CC_STAT_AREA]
+            ar = ws / hs.astype(np.float64)
+            # EXTREMELY lenient parameters to find anything that looks like a bubble
+            keep = (ws >= 10) & (hs >= 10) & (ar >= 0.5) & (ar <= 1.5) & (areas > 50)
+            # All bubbles on a sheet share one radius, so keep only round candidates
+            # near the median size; this drops text and smudges that pass the loose
+            # filter above
+            if keep.any():
+                size = np.maximum(ws, hs)
+                bubble_size = np.median(size[keep])
+                keep &= (size >= BUBBLE_SIZE_BAND[0] * bubble_size) & (size <= BUBBLE_SIZE_BAND[1] * bubble_size)
+                keep &= (ar >= BUBBLE_ASPECT_BAND[0]) & (ar <= BUBBLE_ASPECT_BAND[1])
+            question_boxes = np.stack([xs[keep], ys[keep], ws[keep], hs[keep]], axis=1)
+
+            if len(question_boxes) < 400:
+                return {'error': f'Bubble detection failed (found {len(question_boxes)}). The sample images are not compatible with this CV approach.'}
+
+            boxes = np.asarray(question_boxes, dtype=np.int32)
+            cx = boxes[:, 0] + boxes[:, 2] // 2
+            cy = boxes[:, 1] + boxes[:, 3] // 2
+            radius = max(int(np.median(np.minimum(boxes[:, 2], boxes[:, 3]))) // 2, 1)
+
+            # Level the centroids rather than the image: u runs along the bubble rows
+            # and v across them, so a rotated scan groups and orders like a straight one
+            angle = _row_angle(cx, cy)
+            u = cx * np.cos(angle) + cy * np.sin(angle)
+            v = cy * np.cos(angle) - cx * np.sin(angle)
+
+            # Split the bubbles into rows wherever sorted v jumps by more than a
+            # radius; only rows of exactly 20 are question rows (the legend and stray
+            # marks form shorter ones), and a sheet must have 20 of them
+            by_v = np.argsort(v, kind="stable")
+            starts = np.flatnonzero(np.diff(v[by_v], prepend=v[by_v[0]] - radius - 1) > radius)
+            lengths = np.diff(starts, append=len(by_v))
+            row_starts = starts[lengths == BLOCKS * OPTIONS_PER_QUESTION]
+            if len(row_starts) != ROWS:
+                return {'error': f'Bubble detection failed (found {len(row_starts)} of {ROWS} bubble rows). The sample images are not compatible with this CV approach.'}
+
+            # (row, column) -> bubble index, each row ordered along the row
+            grid = by_v[row_starts[:, None] + np.arange(BLOCKS * OPTIONS_PER_QUESTION)]
+            grid = np.take_along_axis(grid, np.argsort(u[grid], axis=1, kind="stable"), axis=1)
+
+            # Every row and every column should lie on a straight line (perspective
+            # keeps lines straight); a sheet whose bubbles do not would be assigned
+            # to the wrong questions and get a confident wrong score
+            misfit = int(np.count_nonzero(np.maximum(_line_residuals(u[grid], v[grid], axis=1),
+                                                     _line_residuals(v[grid], u[grid], axis=0))
+                                          > GRID_FIT_TOLERANCE * radius))
+            if misfit > GRID_MAX_MISFIT * grid.size:
+                return {'error': f'Bubble detection failed ({misfit} of {grid.size} bubbles off the fitted grid). The sample images are not compatible with this CV approach.'}
+
+            # Fill of a bubble-sized window centred on every bubble where it was found,
+            # read from a summed-area table: four lookups per bubble, all 400 in
+            # one indexing op
+            integral = cv2.integral(thresh, sdepth=cv2.CV_32S)
+            y0 = np.clip(cy[grid] - radius, 0, thresh.shape[0])
+            y1 = np.clip(cy[grid] + radius + 1, 0, thresh.shape[0])
+            x0 = np.clip(cx[grid] - radius, 0, thresh.shape[1])
+            x1 = np.clip(cx[grid] + radius + 1, 0, thresh.shape[1])
+            fills = integral[y1, x1] - integral[y0, x1] - integral[y1, x0] + integral[y0, x0]
+
+            # (row, block, option) -> marked option per question; question = block * 20 + row + 1
+            marked = fills.reshape(ROWS, BLOCKS, OPTIONS_PER_QUESTION).argmax(axis=2).T.ravel()
+
             total_questions = 100
-            options_per_question = 4
-
-            # Group bubbles into rows of 20 (5 questions * 4 options)
-            for (q_row, i) in enumerate(np.arange(0, len(question_cnts), 20)):
-                if q_row >= 20: break # Process only 20 rows of questions
-
-                # Sort the bubbles in the current row from left-to-right
-                row_contours = imutils.contours.sort_contours(question_cnts[i:i + 20])[0]
-                
-                # Iterate through the 5 question blocks in the row
-                for col in range(5):
-                    question_num = (col * 20) + q_row + 1
-                    
-                    # Get the 4 bubbles for this question
-                    cnts = row_contours[col * options_per_question : (col + 1) * options_per_question]
-                    bubbled = None
-                    
-                    for (j, c) in enumerate(cnts):
-                        mask = np.zeros(thresh.shape, dtype="uint8")
-                        cv2.drawContours(mask, [c], -1, 255, -1)
-                        mask = cv2.bitwise_and(thresh, thresh, mask=mask)
-                        total = cv2.countNonZero(mask)
-                        if bubbled is None or total > bubbled[0]:
-                            bubbled = (total, j)
-                    
-                    correct_answer_idx = answer_key.get(str(question_num))
-                    if correct_answer_idx is not None and bubbled[1] == correct_answer_idx:
-                        correct += 1
+            if isinstance(answer_key, np.ndarray):
+                key_arr = answer_key
+            else:
+                key_arr = answer_key_to_array(answer_key, total_questions)
+            hits = marked == key_arr
+            correct = int(np.count_nonzero(hits))
+            # Each block of 20 questions is one subject
+            subject_correct = hits.reshape(BLOCKS, ROWS).sum(axis=1).tolist()
 
             score = (correct / total_questions) * 100
-            return {'total_questions': total_questions, 'correct': correct, 'percentage': score, 'error': None}
+            result = {'total_questions': total_questions, 'correct': correct, 'percentage': score, 'error': None,
+                      'marked': marked.tolist(),
+                      'subject_scores': {f'Subject_{i}': {'correct': c, 'total': ROWS, 'percentage': c / ROWS * 100}
+                                         for i, c in enumerate(subject_correct, start=1)}}
+            if self.debug:
+                # Returned with the result rather than stored on the instance so a
+                # shared processor stays safe to call from several threads
+                annotated = cv2.cvtColor(gray, cv2.COLOR_GRAY2BGR)
+                for x, y in zip(cx[grid].ravel().tolist(), cy[grid].ravel().tolist()):
+                    cv2.circle(annotated, (x, y), radius, (0, 255, 0), 2)
+                result['debug_image'] = annotated
+            return result
         except Exception:
             return {'error': 'A critical error occurred during image processing.'}
@@ -6,6 +6,7 @@ Helper functions for file handling, image processing, and report generation
 """
 
 import os
+import shutil
 import cv2
 import numpy as np
 import base64
@@ -14,14 +15,20 @@ import uuid
 import tempfile
 import zipfile
 from datetime import datetime
-from typing import List, Dict, Optional, Tuple
+from typing import List, Dict, Optional, Tuple, Union
 from PIL import Image, ImageDraw, ImageFont
 import json
 import logging
+import threading
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from models import json_loads, json_dumps_indented
 
 logger = logging.getLogger(__name__)
 
 # File handling utilities
+UPLOAD_CHUNK_SIZE = 1 << 20  # bytes copied per read when saving uploads
+
 def save_uploaded_file(uploaded_file, upload_dir: str = "uploads") -> str:
     """Save uploaded file to temporary directory"""
     try:
@@ -33,9 +40,15 @@ def save_uploaded_file(uploaded_file, upload_dir: str = "uploads") -> str:
         unique_filename = f"{uuid.uuid4()}{file_extension}"
         file_path = os.path.join(upload_dir, unique_filename)
         
-        # Save file
-        with open(file_path, "wb") as f:
-            f.write(uploaded_file.getbuffer())
+        # Stream to disk in 1 MB chunks instead of materializing the whole upload,
+        # leaving the upload where it was for callers that read it afterwards
+        position = uploaded_file.tell()
+        uploaded_file.seek(0)
+        try:
+            with open(file_path, "wb", buffering=UPLOAD_CHUNK_SIZE) as f:
+                shutil.copyfileobj(uploaded_file, f, length=UPLOAD_CHUNK_SIZE)
+        finally:
+            uploaded_file.seek(position)
         
         logger.info(f"File saved: {file_path}")
         return file_path
@@ -44,9 +57,11 @@ def save_uploaded_file(uploaded_file, upload_dir: str = "uploads") -> str:
         logger.error(f"Error saving uploaded file: {e}")
         raise
 
-def create_download_link(data: str, filename: str, mime_type: str = "text/plain") -> str:
-    """Create download link for data"""
-    b64_data = base64.b64encode(data.encode()).decode()
+def create_download_link(data: Union[str, bytes], filename: str, mime_type: str = "text/plain") -> str:
+    """Create download link for text or bytes data"""
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    b64_data = base64.b64encode(data).decode('ascii')
     href = f'<a href="data:{mime_type};base64,{b64_data}" download="{filename}">Download {filename}</a>'
     return href
 
@@ -68,19 +83,20 @@ def validate_image_file(file) -> bool:
         
         # Try to load as image
         if hasattr(file, 'read'):
-            file_bytes = file.read()
-            file.seek(0)  # Reset file pointer
-            
-            # Validate image can be loaded
-            nparr = np.frombuffer(file_bytes, np.uint8)
-            img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-            
-            if img is None:
+            # Validate the image header; Pillow identifies the format from the
+            # magic bytes and reads the size without decoding any pixels. The
+            # file object is handed over as is, so only the header bytes are
+            # read instead of copying the whole upload first
+            try:
+                with Image.open(file) as img:
+                    width, height = img.size
+            except Exception:
                 logger.warning("Could not decode image")
                 return False
+            finally:
+                file.seek(0)  # Reset file pointer
                 
             # Check image dimensions
-            height, width = img.shape[:2]
             if width < 400 or height < 300:
                 logger.warning(f"Image too small: {width}x{height}")
                 return False
@@ -92,8 +108,40 @@ def validate_image_file(file) -> bool:
         return False
 
 # Image processing utilities
-def enhance_image_quality(image: np.ndarray) -> np.ndarray:
-    """Enhance image quality for better OMR processing"""
+# CLAHE objects keep scratch buffers between apply() calls, so one is cached per
+# thread rather than shared; changing these settings needs the cache cleared too
+CLAHE_CLIP_LIMIT = 2.0
+CLAHE_TILE_GRID = (8, 8)
+_clahe_cache = threading.local()
+
+def _get_clahe():
+    """Return this thread's cached CLAHE instance, creating it on first use"""
+    clahe = getattr(_clahe_cache, 'clahe', None)
+    if clahe is None:
+        clahe = cv2.createCLAHE(clipLimit=CLAHE_CLIP_LIMIT, tileGridSize=CLAHE_TILE_GRID)
+        _clahe_cache.clahe = clahe
+    return clahe
+
+DENOISE_METHODS = ("gaussian", "bilateral", "nlm", "none")
+
+def enhance_image_quality(image: np.ndarray, denoise: str = "gaussian",
+                          fast_mode: bool = False) -> np.ndarray:
+    """Enhance image quality for better OMR processing
+    
+    denoise is "gaussian" (default), "bilateral", "nlm" or "none". Non-local
+    means used to be unconditional and dominated the cost of this function;
+    it is kept for badly degraded scans only, and runs on the OpenCL device
+    when one is available.
+    
+    With fast_mode=True the sheet is binarized in one adaptive-threshold pass
+    (bubbles white on black) instead of being contrast-enhanced and denoised,
+    for callers that only need the bubble map.
+    """
+    # A bad argument is the caller's bug, not an unreadable image: raise it
+    # rather than letting the handler below return the input unchanged
+    if denoise not in DENOISE_METHODS:
+        raise ValueError(f"Unknown denoise method: {denoise}")
+    
     try:
         # Convert to grayscale if needed
         if len(image.shape) == 3:
@@ -101,12 +149,30 @@ def enhance_image_quality(image: np.ndarray) -> np.ndarray:
         else:
             gray = image.copy()
         
+        if fast_mode:
+            return cv2.adaptiveThreshold(gray, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C,
+                                         cv2.THRESH_BINARY_INV, 25, 10)
+        
         # Apply CLAHE (Contrast Limited Adaptive Histogram Equalization)
-        clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8))
+        clahe = _get_clahe()
+        
+        if denoise == "nlm" and cv2.ocl.haveOpenCL():
+            # Run CLAHE and NLM on one UMat so OpenCV dispatches both to the
+            # OpenCL device, with a single upload and download
+            enhanced = clahe.apply(cv2.UMat(gray))
+            return cv2.fastNlMeansDenoising(enhanced).get()
+        
         enhanced = clahe.apply(gray)
         
         # Denoise
-        denoised = cv2.fastNlMeansDenoising(enhanced)
+        if denoise == "gaussian":
+            denoised = cv2.GaussianBlur(enhanced, (3, 3), 0)
+        elif denoise == "bilateral":
+            denoised = cv2.bilateralFilter(enhanced, 5, 40, 40)
+        elif denoise == "nlm":
+            denoised = cv2.fastNlMeansDenoising(enhanced)
+        else:  # "none"
+            denoised = enhanced
         
         return denoised
         
@@ -114,8 +180,10 @@ def enhance_image_quality(image: np.ndarray) -> np.ndarray:
         logger.error(f"Error enhancing image: {e}")
         return image
 
+SKEW_DETECTION_EDGE = 600  # longest edge of the image skew is estimated on
+
 def correct_image_skew(image: np.ndarray) -> Tuple[np.ndarray, float]:
-    """Correct image skew using Hough Transform"""
+    """Correct image skew using a probabilistic Hough Transform"""
     try:
         # Convert to grayscale if needed
         if len(image.shape) == 3:
@@ -123,29 +191,31 @@ def correct_image_skew(image: np.ndarray) -> Tuple[np.ndarray, float]:
         else:
             gray = image.copy()
         
-        # Apply edge detection
+        # Estimate skew on a small edge map; the angle is scale-invariant
+        (h, w) = gray.shape[:2]
+        scale = min(1.0, SKEW_DETECTION_EDGE / float(max(h, w)))
+        if scale < 1.0:
+            gray = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
         edges = cv2.Canny(gray, 50, 150, apertureSize=3)
         
-        # Apply Hough Line Transform
-        lines = cv2.HoughLines(edges, 1, np.pi / 180, threshold=100)
+        # Probabilistic Hough returns segment endpoints, far cheaper than the full SHT
+        segments = cv2.HoughLinesP(edges, 1, np.pi / 180, threshold=80,
+                                   minLineLength=40, maxLineGap=10)
         
-        if lines is None:
+        if segments is None:
             return image, 0.0
         
-        # Calculate angles
-        angles = []
-        for rho, theta in lines[:, 0]:
-            angle = theta * 180 / np.pi
-            if angle < 45:
-                angles.append(angle)
-            elif angle > 135:
-                angles.append(angle - 180)
+        # Direction of each segment, keeping the near-horizontal ones
+        x1, y1, x2, y2 = segments.reshape(-1, 4).astype(np.float64).T
+        angles = np.degrees(np.arctan2(y2 - y1, x2 - x1))
+        angles = np.where(angles > 90, angles - 180, np.where(angles < -90, angles + 180, angles))
+        angles = angles[np.abs(angles) < 45]
         
-        if not angles:
+        if not angles.size:
             return image, 0.0
         
         # Calculate median angle
-        median_angle = np.median(angles)
+        median_angle = float(np.median(angles))
         
         # Rotate image to correct skew
         if abs(median_angle) > 0.5:  # Only correct if skew is significant
@@ -161,7 +231,8 @@ def correct_image_skew(image: np.ndarray) -> Tuple[np.ndarray, float]:
         logger.error(f"Error correcting skew: {e}")
         return image, 0.0
 
-def create_debug_image(original: np.ndarray, contours: List, bubbles: List[Dict]) -> np.ndarray:
+def create_debug_image(original: np.ndarray, contours: List, bubbles: List[Dict],
+                       show_labels: bool = True, max_contours: Optional[int] = None) -> np.ndarray:
     """Create debug image showing detected contours and bubbles"""
     try:
         # Create color version of image
@@ -170,7 +241,9 @@ def create_debug_image(original: np.ndarray, contours: List, bubbles: List[Dict]
         else:
             debug_img = original.copy()
         
-        # Draw all contours in blue
+        # Draw contours in blue, optionally only the largest few
+        if max_contours is not None and len(contours) > max_contours:
+            contours = sorted(contours, key=cv2.contourArea, reverse=True)[:max_contours]
         cv2.drawContours(debug_img, contours, -1, (255, 0, 0), 2)
         
         # Draw detected bubbles
@@ -185,10 +258,11 @@ def create_debug_image(original: np.ndarray, contours: List, bubbles: List[Dict]
             cv2.circle(debug_img, center, 10, color, 2)
             
             # Draw fill percentage text
-            fill_pct = bubble.get('fill_percentage', 0) * 100
-            cv2.putText(debug_img, f"{fill_pct:.1f}%", 
-                       (center[0] - 20, center[1] - 15),
-                       cv2.FONT_HERSHEY_SIMPLEX, 0.3, color, 1)
+            if show_labels:
+                fill_pct = bubble.get('fill_percentage', 0) * 100
+                cv2.putText(debug_img, f"{fill_pct:.1f}%", 
+                           (center[0] - 20, center[1] - 15),
+                           cv2.FONT_HERSHEY_SIMPLEX, 0.3, color, 1)
         
         return debug_img
         
@@ -237,20 +311,25 @@ def generate_score_summary(results: Dict) -> str:
 def create_results_json(results: List[Dict]) -> str:
     """Create JSON format of results for export"""
     try:
+        n = len(results)
+        percentages = np.fromiter((r['percentage'] for r in results), dtype=np.float64, count=n)
+        total_questions = np.fromiter((r['total_questions'] for r in results), dtype=np.int64, count=n)
+        correct = np.fromiter((r['correct'] for r in results), dtype=np.int64, count=n)
+        
         export_data = {
             'export_timestamp': datetime.now().isoformat(),
-            'total_sheets': len(results),
+            'total_sheets': n,
             'results': results,
             'summary_statistics': {
-                'average_score': np.mean([r['percentage'] for r in results]),
-                'max_score': max([r['percentage'] for r in results]),
-                'min_score': min([r['percentage'] for r in results]),
-                'total_questions_processed': sum([r['total_questions'] for r in results]),
-                'total_correct_answers': sum([r['correct'] for r in results])
+                'average_score': float(percentages.mean()),
+                'max_score': float(percentages.max()),
+                'min_score': float(percentages.min()),
+                'total_questions_processed': int(total_questions.sum()),
+                'total_correct_answers': int(correct.sum())
             }
         }
         
-        return json.dumps(export_data, indent=2)
+        return json_dumps_indented(export_data)
         
     except Exception as e:
         logger.error(f"Error creating JSON export: {e}")
@@ -330,57 +409,100 @@ def generate_report_pdf(results: Dict, filename: str) -> Optional[str]:
         return None
 
 # Batch processing utilities
+_batch_processor = None
+_batch_preprocess = None
+
+def _init_batch_worker(processor, preprocess=None):
+    """Install the processor (and optional array preprocessor) each worker process uses"""
+    global _batch_processor, _batch_preprocess
+    _batch_processor = processor
+    _batch_preprocess = preprocess
+    # The pool already runs one sheet per core; nested library threads would oversubscribe
+    setup_runtime(num_threads=1)
+
+def _process_image_path(image_path: str, answer_key: Dict) -> Dict:
+    """Read and score one sheet inside a worker process"""
+    if _batch_preprocess is not None:
+        # Enhance in memory and hand the array straight to the processor,
+        # rather than writing an enhanced copy to disk and decoding it again
+        image = cv2.imread(image_path, cv2.IMREAD_COLOR)
+        if image is None:
+            return {'error': 'Failed to decode image.'}
+        return _batch_processor.process_omr_sheet(_batch_preprocess(image), answer_key)
+    
+    with open(image_path, "rb") as f:
+        image_bytes = f.read()
+    return _batch_processor.process_omr_sheet(image_bytes, answer_key)
+
 def process_images_batch(image_paths: List[str], answer_key: Dict, 
-                        processor, progress_callback=None) -> List[Dict]:
-    """Process multiple images in batch"""
+                        processor, progress_callback=None,
+                        max_workers: Optional[int] = None,
+                        preprocess=None) -> List[Dict]:
+    """Process multiple images in batch across worker processes
+    
+    preprocess, if given, is a picklable function applied to each decoded BGR
+    sheet before scoring (e.g. preprocess_images.enhance_array).
+    """
     results = []
     
-    for i, image_path in enumerate(image_paths):
-        try:
-            # Update progress
-            if progress_callback:
-                progress_callback(i, len(image_paths), image_path)
-            
-            # Process image
-            result = processor.process_omr_sheet(image_path, answer_key)
-            
-            if 'error' not in result:
-                result['filename'] = os.path.basename(image_path)
-                result['processed_at'] = datetime.now().isoformat()
-                results.append(result)
-            else:
-                logger.error(f"Error processing {image_path}: {result['error']}")
+    with ProcessPoolExecutor(max_workers=max_workers or os.cpu_count(),
+                             initializer=_init_batch_worker,
+                             initargs=(processor, preprocess)) as executor:
+        futures = {
+            executor.submit(_process_image_path, image_path, answer_key): image_path
+            for image_path in image_paths
+        }
+        
+        for i, future in enumerate(as_completed(futures)):
+            image_path = futures[future]
+            try:
+                # Update progress
+                if progress_callback:
+                    progress_callback(i, len(image_paths), image_path)
+                
+                result = future.result()
                 
-        except Exception as e:
-            logger.error(f"Unexpected error processing {image_path}: {e}")
+                if result.get('error') is None:
+                    result['filename'] = os.path.basename(image_path)
+                    result['processed_at'] = datetime.now().isoformat()
+                    results.append(result)
+                else:
+                    logger.error(f"Error processing {image_path}: {result['error']}")
+                    
+            except Exception as e:
+                logger.error(f"Unexpected error processing {image_path}: {e}")
     
     return results
 
+SCORE_BUCKET_EDGES = np.array([60, 70, 80, 90])  # lower bounds of the report grade buckets
+
 def create_batch_report(results: List[Dict]) -> Dict:
     """Create comprehensive batch processing report"""
     if not results:
         return {'error': 'No results to analyze'}
     
     # Calculate statistics
-    scores = [r['percentage'] for r in results]
-    correct_answers = [r['correct'] for r in results]
+    scores = np.array([r['percentage'] for r in results], dtype=np.float64)
+    # One pass buckets every score: 0 = poor (<60) ... 4 = excellent (>=90)
+    bucket_counts = np.bincount(np.digitize(scores, SCORE_BUCKET_EDGES),
+                                minlength=len(SCORE_BUCKET_EDGES) + 1)
     
     batch_report = {
         'processing_summary': {
             'total_sheets': len(results),
             'successfully_processed': len(results),
-            'average_score': np.mean(scores),
+            'average_score': scores.mean(),
             'median_score': np.median(scores),
-            'std_deviation': np.std(scores),
-            'min_score': min(scores),
-            'max_score': max(scores)
+            'std_deviation': scores.std(),
+            'min_score': scores.min(),
+            'max_score': scores.max()
         },
         'score_distribution': {
-            'excellent (90-100%)': len([s for s in scores if s >= 90]),
-            'good (80-89%)': len([s for s in scores if 80 <= s < 90]),
-            'average (70-79%)': len([s for s in scores if 70 <= s < 80]),
-            'below_average (60-69%)': len([s for s in scores if 60 <= s < 70]),
-            'poor (<60%)': len([s for s in scores if s < 60])
+            'excellent (90-100%)': int(bucket_counts[4]),
+            'good (80-89%)': int(bucket_counts[3]),
+            'average (70-79%)': int(bucket_counts[2]),
+            'below_average (60-69%)': int(bucket_counts[1]),
+            'poor (<60%)': int(bucket_counts[0])
         },
         'detailed_results': results,
         'generated_at': datetime.now().isoformat()
@@ -433,7 +555,7 @@ def validate_answer_key_file(file_content: str) -> Tuple[bool, str, Optional[Dic
     """Validate answer key file content"""
     try:
         # Parse JSON
-        answer_key = json.loads(file_content)
+        answer_key = json_loads(file_content)
         
         if not isinstance(answer_key, dict):
             return False, "Answer key must be a JSON object", None
@@ -457,59 +579,67 @@ def validate_answer_key_file(file_content: str) -> Tuple[bool, str, Optional[Dic
         
         return True, f"Valid answer key with {len(validated_key)} questions", validated_key
         
-    except json.JSONDecodeError as e:
+    except json.JSONDecodeError as e:  # orjson.JSONDecodeError subclasses it
         return False, f"Invalid JSON format: {str(e)}", None
     except Exception as e:
         return False, f"Validation error: {str(e)}", None
 
+_default_font = None
+
+def _get_default_font():
+    """Load PIL's default bitmap font once and reuse it for every label"""
+    global _default_font
+    if _default_font is None:
+        _default_font = ImageFont.load_default()
+    return _default_font
+
+def _ring_offsets(radius: int, thickness: int = 2) -> Tuple[np.ndarray, np.ndarray]:
+    """Pixel offsets (dy, dx) of a ring of the given outer radius and thickness"""
+    yy, xx = np.ogrid[-radius:radius + 1, -radius:radius + 1]
+    d2 = xx * xx + yy * yy
+    # Fractional bounds reproduce PIL's draw.ellipse(width=thickness) outline
+    dy, dx = np.nonzero((d2 >= (radius - thickness + 0.5) ** 2) & (d2 <= (radius + 0.25) ** 2))
+    return dy - radius, dx - radius
+
 def create_sample_omr_image(width: int = 800, height: int = 1200) -> np.ndarray:
     """Create a sample OMR sheet image for testing"""
     try:
         # Create white background
-        image = np.ones((height, width, 3), dtype=np.uint8) * 255
-        
-        # Convert to PIL for easier drawing
-        pil_image = Image.fromarray(image)
-        draw = ImageDraw.Draw(pil_image)
-        
-        # Draw title
-        draw.text((width//2 - 100, 50), "SAMPLE OMR SHEET", fill=(0, 0, 0))
+        image = np.full((height, width, 3), 255, dtype=np.uint8)
         
-        # Draw bubbles for 100 questions (20 rows x 5 columns)
+        # Bubbles for 100 questions (20 rows x 5 options)
         bubble_radius = 8
         start_x = 100
         start_y = 150
         col_spacing = 30
         row_spacing = 40
+        rows, options = 20, 5
         
-        question_num = 1
+        row_y = start_y + np.arange(rows) * row_spacing
+        col_x = start_x + np.arange(options) * col_spacing
         
-        for row in range(20):  # 20 rows
-            y = start_y + row * row_spacing
-            
+        # Stamp every bubble outline in one indexing operation
+        dy, dx = _ring_offsets(bubble_radius)
+        cy = np.repeat(row_y, options)[:, None] + dy
+        cx = np.tile(col_x, rows)[:, None] + dx
+        inside = (cy >= 0) & (cy < height) & (cx >= 0) & (cx < width)
+        image[cy[inside], cx[inside]] = 0
+        
+        # Text is still drawn by PIL, with one shared font
+        pil_image = Image.fromarray(image)
+        draw = ImageDraw.Draw(pil_image)
+        font = _get_default_font()
+        
+        # Draw title
+        draw.text((width//2 - 100, 50), "SAMPLE OMR SHEET", fill=(0, 0, 0), font=font)
+        
+        for row, y in enumerate(row_y.tolist()):
             # Question number
-            draw.text((50, y - 5), str(question_num), fill=(0, 0, 0))
+            draw.text((50, y - 5), str(row + 1), fill=(0, 0, 0), font=font)
             
-            for col in range(5):  # 5 options (A, B, C, D, E)
-                x = start_x + col * col_spacing
-                
-                # Draw bubble circle
-                draw.ellipse([x - bubble_radius, y - bubble_radius, 
-                            x + bubble_radius, y + bubble_radius], 
-                           outline=(0, 0, 0), width=2)
-                
-                # Draw option letter
-                option_letter = chr(ord('A') + col)
-                draw.text((x - 3, y - 25), option_letter, fill=(0, 0, 0))
-            
-            question_num += 1
-            
-            # Add more columns for remaining questions
-            if question_num <= 100 and question_num % 20 == 1:
-                start_x += 200  # Move to next column group
-                if start_x > width - 200:
-                    start_x = 100
-                    start_y += 500  # Move to next row group
+            # Option letters (A, B, C, D, E)
+            for col, x in enumerate(col_x.tolist()):
+                draw.text((x - 3, y - 25), chr(ord('A') + col), fill=(0, 0, 0), font=font)
         
         # Convert back to numpy array
         return np.array(pil_image)
@@ -517,7 +647,7 @@ def create_sample_omr_image(width: int = 800, height: int = 1200) -> np.ndarray:
     except Exception as e:
         logger.error(f"Error creating sample OMR image: {e}")
         # Return blank white image as fallback
-        return np.ones((height, width, 3), dtype=np.uint8) * 255
+        return np.full((height, width, 3), 255, dtype=np.uint8)
 
 # Logging utilities
 def setup_logging(log_level: str = "INFO", log_file: str = "omr_system.log"):
@@ -536,6 +666,17 @@ def setup_logging(log_level: str = "INFO", log_file: str = "omr_system.log"):
     
     logger.info("Logging configured successfully")
 
+# Runtime utilities
+def setup_runtime(num_threads: Optional[int] = None):
+    """Set the thread count used by OpenCV in this process
+    
+    Batch worker processes call this with num_threads=1 so that parallelism comes
+    from the process pool alone; the default uses every core for a single process.
+    """
+    num_threads = num_threads or os.cpu_count() or 1
+    cv2.setNumThreads(num_threads)
+    logger.debug(f"Runtime configured for {num_threads} thread(s)")
+
 # Error handling utilities
 def handle_processing_error(error: Exception, context: str) -> Dict:
     """Standard error handling for processing operations"""
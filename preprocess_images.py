@@ -1,27 +1,80 @@
 import os
 import cv2
-from PIL import Image, ImageEnhance
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from turbojpeg import TurboJPEG
+    turbo_jpeg = TurboJPEG()
+except (ImportError, OSError, RuntimeError):  # libjpeg-turbo is an optional speedup
+    turbo_jpeg = None
+
+JPEG_EXTENSIONS = ('.jpg', '.jpeg')
+
+def read_image(path):
+    """
+    Reads an image as a BGR array, decoding JPEGs with libjpeg-turbo when available.
+    """
+    if turbo_jpeg is not None and path.lower().endswith(JPEG_EXTENSIONS):
+        with open(path, 'rb') as f:
+            return turbo_jpeg.decode(f.read())
+    return cv2.imread(path, cv2.IMREAD_COLOR)
+
+def write_image(path, img, quality=95):
+    """
+    Writes a BGR array, encoding JPEGs with libjpeg-turbo when available.
+    """
+    if turbo_jpeg is not None and path.lower().endswith(JPEG_EXTENSIONS):
+        with open(path, 'wb') as f:
+            f.write(turbo_jpeg.encode(img, quality=quality))
+        return True
+    return cv2.imwrite(path, img, [cv2.IMWRITE_JPEG_QUALITY, quality])
+
+def enhance_array(img, contrast_factor=1.5, sharpness_factor=1.2):
+    """
+    Enhances the contrast and sharpness of a decoded BGR image array.
+    """
+    # Enhance Contrast: stretch around the mean grey level, like ImageEnhance.Contrast
+    mean = cv2.mean(cv2.cvtColor(img, cv2.COLOR_BGR2GRAY))[0]
+    img = cv2.addWeighted(img, contrast_factor, img, 0, (1 - contrast_factor) * mean)
+
+    # Enhance Sharpness: unsharp mask against a Gaussian blur
+    k = sharpness_factor - 1
+    return cv2.addWeighted(img, 1 + k, cv2.GaussianBlur(img, (0, 0), 1.0), -k, 0)
 
 def enhance_image(image_path, output_path, contrast_factor=1.5, sharpness_factor=1.2):
     """
-    Enhances the contrast and sharpness of an image.
+    Enhances the contrast and sharpness of an image file.
     """
     try:
-        with Image.open(image_path) as img:
-            # Enhance Contrast
-            enhancer = ImageEnhance.Contrast(img)
-            img_contrasted = enhancer.enhance(contrast_factor)
-            
-            # Enhance Sharpness
-            enhancer = ImageEnhance.Sharpness(img_contrasted)
-            img_sharp = enhancer.enhance(sharpness_factor)
-            
-            img_sharp.save(output_path, quality=95)
+        img = read_image(image_path)
+        if img is None:
+            raise ValueError("could not read image")
+
+        img = enhance_array(img, contrast_factor, sharpness_factor)
+
+        if not write_image(output_path, img):
+            raise ValueError("could not write image")
         return True
     except Exception as e:
         print(f"Error enhancing {image_path}: {e}")
         return False
 
+async def enhance_all(jobs, max_workers=32):
+    """
+    Enhances every (input_path, output_path, filename, output_folder) job concurrently.
+    Reading and writing dominate, and OpenCV releases the GIL while decoding,
+    filtering and encoding, so a thread pool keeps the disk busy.
+    """
+    loop = asyncio.get_running_loop()
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        async def run(input_path, output_path, filename, output_folder):
+            if await loop.run_in_executor(executor, enhance_image, input_path, output_path):
+                print(f"  ✓ Enhanced '{filename}' and saved to '{output_folder}'")
+
+        await asyncio.gather(*(run(*job) for job in jobs))
+
 def main():
     # Define the folders for your hackathon data
     input_folders = ["data/SetA", "data/SetB"]
@@ -32,6 +85,7 @@ def main():
     
     print("Starting image pre-processing...")
 
+    jobs = []
     for folder in input_folders:
         output_folder = os.path.join(output_parent_folder, os.path.basename(folder))
         os.makedirs(output_folder, exist_ok=True)
@@ -42,14 +96,15 @@ def main():
 
         image_files = [f for f in os.listdir(folder) if f.lower().endswith(('.png', '.jpg', '.jpeg'))]
         
-        print(f"\nProcessing {len(image_files)} images in '{folder}'...")
+        print(f"Queued {len(image_files)} images in '{folder}'...")
         
         for filename in image_files:
             input_path = os.path.join(folder, filename)
             output_path = os.path.join(output_folder, filename)
-            
-            if enhance_image(input_path, output_path):
-                print(f"  ✓ Enhanced '{filename}' and saved to '{output_folder}'")
+            jobs.append((input_path, output_path, filename, output_folder))
+
+    print(f"\nProcessing {len(jobs)} images...")
+    asyncio.run(enhance_all(jobs))
 
     print("\nPre-processing complete! The enhanced images are in the 'data/processed' directory.")
     print("Now, run the Streamlit app and upload the images from these new folders.")
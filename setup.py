@@ -32,6 +32,8 @@ setup(
         "scikit-learn>=1.3.0",
         "scipy>=1.11.2",
         "imutils>=0.5.4",
+        "orjson>=3.9",
+        "PyTurboJPEG>=1.7",
         "matplotlib>=3.7.2",
         "seaborn>=0.12.2",
         "SQLAlchemy>=2.0.21",
@@ -9,34 +9,115 @@ import unittest
 import numpy as np
 import cv2
 import json
+import sqlite3
+import random
 import sys
 import os
+import io
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import lru_cache
+from unittest.mock import patch, mock_open
 
-# Add app directory to Python path
-sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'app'))
+# Add app directory to Python path, once, ahead of any same-named installed modules
+APP_DIR = os.path.normpath(os.path.join(os.path.dirname(__file__), '..', 'app'))
+if APP_DIR not in sys.path:
+    sys.path.insert(0, APP_DIR)
 
 from omr_processor import OMRProcessor, create_sample_answer_key, validate_answer_key
-from models import Database, OMRResult
-from utils import validate_image_file, enhance_image_quality, correct_image_skew
+from models import Database, OMRResult, export_results_to_csv
+from utils import validate_image_file, enhance_image_quality, correct_image_skew, setup_runtime
+
+_previous_cv_threads = None
+
+def setUpModule():
+    """Give OpenCV one thread per process while this module's tests run"""
+    # Test images are small and test classes may run in parallel processes, so
+    # OpenCV gets one thread per process like the batch workers; OMR_CV_THREADS
+    # overrides (0 = every core)
+    global _previous_cv_threads
+    _previous_cv_threads = cv2.getNumThreads()
+    setup_runtime(num_threads=int(os.environ.get("OMR_CV_THREADS", "1")))
+
+def tearDownModule():
+    """Restore OpenCV's thread count for whatever runs after this module"""
+    cv2.setNumThreads(_previous_cv_threads)
+
+# Seeded noise images, generated once from raw PRNG bytes and shared read-only
+_RNG = np.random.default_rng(0)
+
+def _noise_image(*shape) -> np.ndarray:
+    """Deterministic uint8 noise image of the given shape"""
+    return np.frombuffer(_RNG.bytes(int(np.prod(shape))), dtype=np.uint8).reshape(shape).copy()
+
+FIXTURE_DIR = os.path.join(os.path.dirname(__file__), 'fixtures')
+
+def _noise_fixture(name: str, *shape) -> np.ndarray:
+    """Seeded noise image cached as tests/fixtures/<name>.npy and memory-mapped read-only"""
+    path = os.path.join(FIXTURE_DIR, f"{name}.npy")
+    if not os.path.exists(path):
+        # Own seed so the file matches whichever run writes it first
+        rng = np.random.default_rng(int(np.prod(shape)))
+        image = np.frombuffer(rng.bytes(int(np.prod(shape))), dtype=np.uint8).reshape(shape)
+        os.makedirs(FIXTURE_DIR, exist_ok=True)
+        # Write then rename, so test processes started together never see a partial file
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            np.save(f, image)
+        os.replace(tmp_path, path)
+    return np.load(path, mmap_mode='r')
+
+_NOISE_600x800x3 = _noise_fixture('noise_600x800x3', 600, 800, 3)
+_NOISE_400x600 = _noise_image(400, 600)
+_NOISE_400x600x3 = _noise_image(400, 600, 3)
+
+# Fixtures only need to round-trip through the decoder, so encode for speed
+FAST_JPEG_PARAMS = [int(cv2.IMWRITE_JPEG_QUALITY), 50, int(cv2.IMWRITE_JPEG_OPTIMIZE), 0]
+
+@lru_cache(maxsize=None)
+def _answer_key(num_questions: int) -> dict:
+    """Deterministic answer key fixture, built once per size (treat as read-only)"""
+    rng = random.Random(num_questions)
+    return {i: rng.randrange(5) for i in range(1, num_questions + 1)}
+
+def _grid_sheet(answer_key: dict) -> np.ndarray:
+    """Synthetic 20-row sheet: 5 blocks of 20 questions x 4 options, key answers filled in"""
+    image = np.full((1100, 1000, 3), 255, dtype=np.uint8)
+    for row in range(20):
+        for block in range(5):
+            answer = answer_key.get(block * 20 + row + 1)
+            for option in range(4):
+                center = (60 + block * 190 + option * 40, 60 + row * 50)
+                cv2.circle(image, center, 14, (0, 0, 0), 2)
+                if option == answer:
+                    cv2.circle(image, center, 13, (0, 0, 0), -1)
+    return image
 
 class TestOMRProcessor(unittest.TestCase):
     """Test OMR processing functionality"""
     
-    def setUp(self):
-        """Set up test fixtures"""
-        self.processor = OMRProcessor(debug=True)
-        self.sample_answer_key = create_sample_answer_key(20)  # Small test set
+    @classmethod
+    def setUpClass(cls):
+        """Set up test fixtures shared by every test in the class"""
+        cls.processor = OMRProcessor(debug=True)
+        cls.sample_answer_key = _answer_key(20)  # Small test set
+        # Built and encoded once; tests that draw on it work on a copy
+        cls._blank_image = np.full((800, 600, 3), 255, dtype=np.uint8)
+        # imencode's output array is kept and handed out as a memoryview, not copied by tobytes()
+        cls._encoded_buffer = memoryview(cv2.imencode('.jpg', cls._blank_image, FAST_JPEG_PARAMS)[1])
     
     def test_answer_key_creation(self):
         """Test answer key generation"""
         answer_key = create_sample_answer_key(100)
         
         self.assertEqual(len(answer_key), 100)
-        for question_num, answer in answer_key.items():
-            self.assertIsInstance(question_num, int)
-            self.assertGreaterEqual(question_num, 1)
-            self.assertLessEqual(question_num, 100)
-            self.assertIn(answer, [0, 1, 2, 3, 4])
+        # Question numbers must be real ints: NumPy would coerce digit strings below
+        self.assertEqual(set(map(type, answer_key)), {int})
+        
+        # Range checks over every entry in one sweep each
+        questions = np.fromiter(answer_key.keys(), dtype=np.int64, count=len(answer_key))
+        answers = np.fromiter(answer_key.values(), dtype=np.int64, count=len(answer_key))
+        self.assertTrue(((questions >= 1) & (questions <= 100)).all())
+        self.assertTrue(np.isin(answers, [0, 1, 2, 3, 4]).all())
     
     def test_answer_key_validation(self):
         """Test answer key validation"""
@@ -48,60 +129,125 @@ class TestOMRProcessor(unittest.TestCase):
     
     def test_image_loading_from_array(self):
         """Test image loading from numpy array"""
-        # Create test image
-        test_image = np.ones((600, 800, 3), dtype=np.uint8) * 255
-        
-        # Convert to bytes (simulate file upload)
-        _, buffer = cv2.imencode('.jpg', test_image)
-        image_bytes = buffer.tobytes()
-        
-        success = self.processor.load_image_from_bytes(image_bytes)
+        success = self.processor.load_image_from_array(self._blank_image)
+        self.assertTrue(success)
+        self.assertIsNotNone(self.processor.original_image)
+        self.assertEqual(self.processor.original_image.shape, self._blank_image.shape)
+    
+    def test_image_loading_from_bytes(self):
+        """Test image loading from encoded bytes"""
+        # Pre-encoded bytes simulate a file upload
+        success = self.processor.load_image_from_bytes(self._encoded_buffer)
         self.assertTrue(success)
         self.assertIsNotNone(self.processor.original_image)
     
     def test_preprocessing(self):
-        """Test image preprocessing"""
-        # Create test image
-        test_image = np.random.randint(0, 255, (600, 800, 3), dtype=np.uint8)
-        self.processor.original_image = test_image
+        """Test that an image without a bubble grid is rejected, not scored"""
+        # Shared noise image
+        result = self.processor.process_omr_sheet(np.ascontiguousarray(_NOISE_600x800x3), self.sample_answer_key)
         
-        edged = self.processor.preprocess_image()
-        
-        self.assertIsNotNone(edged)
-        self.assertEqual(len(edged.shape), 2)  # Should be grayscale
+        self.assertIsNotNone(result['error'])
+        self.assertNotIn('correct', result)
     
     def test_bubble_detection(self):
-        """Test bubble detection on synthetic image"""
-        # Create synthetic OMR-like image
-        test_image = np.ones((800, 600, 3), dtype=np.uint8) * 255
+        """Test bubble detection on a synthetic sheet"""
+        answer_key = create_sample_answer_key(100, seed=0)
+        
+        result = self.processor.process_omr_sheet(_grid_sheet(answer_key), answer_key)
+        
+        self.assertIsNone(result['error'])
+        self.assertEqual(result['correct'], 100)
+        self.assertIn('debug_image', result)
+    
+    def test_rotated_sheet(self):
+        """Test that a slightly rotated scan is levelled and still scored correctly"""
+        answer_key = create_sample_answer_key(100, seed=0)
+        sheet = _grid_sheet(answer_key)
+        rotation = cv2.getRotationMatrix2D((sheet.shape[1] / 2, sheet.shape[0] / 2), 2, 1)
+        rotated = cv2.warpAffine(sheet, rotation, sheet.shape[1::-1], borderValue=(255, 255, 255))
+        
+        result = self.processor.process_omr_sheet(rotated, answer_key)
+        
+        self.assertIsNone(result['error'])
+        self.assertEqual(result['correct'], 100)
+    
+    def test_misaligned_sheet_rejected(self):
+        """Test that a sheet whose bubbles do not form the 20x20 grid is rejected, not scored"""
+        answer_key = create_sample_answer_key(100, seed=0)
+        sheet = _grid_sheet(answer_key)
+        sheet[80:130] = 255  # blank out the second row of bubbles
+        # A stray row of 20 bubbles off the option columns stands in for it
+        for x in range(20):
+            cv2.circle(sheet, (60 + x * 45, 1080), 14, (0, 0, 0), 2)
         
-        # Draw some circles (bubbles)
-        cv2.circle(test_image, (100, 100), 15, (0, 0, 0), 2)
-        cv2.circle(test_image, (200, 100), 15, (0, 0, 0), -1)  # Filled
-        cv2.circle(test_image, (300, 100), 15, (0, 0, 0), 2)
+        result = self.processor.process_omr_sheet(sheet, answer_key)
         
-        bubbles = self.processor.detect_bubbles(test_image)
-        self.assertGreater(len(bubbles), 0)
+        self.assertIn('off the fitted grid', result['error'])
+    
+    def test_bubble_detection_many_sheets(self):
+        """Test bubble detection on many seeded synthetic sheets in parallel"""
+        seeds = range(32)
+        keys = [create_sample_answer_key(100, seed=seed) for seed in seeds]
+        # OpenCV releases the GIL, so sheets score concurrently on one shared processor
+        with ThreadPoolExecutor() as executor:
+            results = list(executor.map(
+                lambda key: self.processor.process_omr_sheet(_grid_sheet(key), key), keys))
+        
+        for seed, result in zip(seeds, results):
+            with self.subTest(seed=seed):
+                self.assertIsNone(result['error'])
+                self.assertEqual(result['correct'], 100)
     
     def test_score_calculation(self):
         """Test score calculation functionality"""
-        answer_key = {1: 0, 2: 1, 3: 2, 4: 3, 5: 4}
-        extracted_answers = {1: 0, 2: 1, 3: 1, 4: 3, 5: -1}  # Mixed results
+        answer_key = create_sample_answer_key(100, seed=1)
+        # Sheet marked from the key with five answers shifted to the next option
+        marked = dict(answer_key)
+        for q in (1, 21, 42, 63, 100):
+            marked[q] = (marked[q] + 1) % 4
         
-        results = self.processor.calculate_scores(extracted_answers, answer_key)
+        results = self.processor.process_omr_sheet(_grid_sheet(marked), answer_key)
         
-        self.assertIn('total_questions', results)
-        self.assertIn('correct', results)
-        self.assertIn('percentage', results)
-        self.assertEqual(results['total_questions'], len(answer_key))
-        self.assertGreater(results['correct'], 0)
+        # One structural comparison; a failure diff still names every broken check
+        checks = {
+            'has_result_keys': {'total_questions', 'correct', 'percentage'} <= results.keys(),
+            'total_questions': results.get('total_questions'),
+            'correct': results.get('correct'),
+            'percentage': results.get('percentage'),
+        }
+        self.assertEqual(checks, {
+            'has_result_keys': True,
+            'total_questions': len(answer_key),
+            'correct': 95,
+            'percentage': 95.0,
+        })
 
 class TestDatabase(unittest.TestCase):
     """Test database functionality"""
     
-    def setUp(self):
+    @classmethod
+    def setUpClass(cls):
         """Set up test database"""
-        self.db = Database(":memory:")  # Use in-memory database for testing
+        # One in-memory database for the class: schema and PRAGMAs run once
+        cls.db = Database(":memory:")
+        # Durability is irrelevant for a throwaway database
+        cls.db.conn.executescript("PRAGMA synchronous=OFF; PRAGMA journal_mode=MEMORY;")
+    
+    @classmethod
+    def tearDownClass(cls):
+        """Close the shared test database"""
+        cls.db.close()
+    
+    def tearDown(self):
+        """Empty the tables so every test starts from a clean database"""
+        # Database methods manage their own transactions, so tests cannot be
+        # wrapped in BEGIN/ROLLBACK; clearing the rows is the cheap reset
+        with self.db.lock:
+            self.db.conn.executescript("""
+                DELETE FROM omr_results;
+                DELETE FROM answer_keys;
+                DELETE FROM settings;
+            """)
     
     def test_database_creation(self):
         """Test database table creation"""
@@ -126,6 +272,58 @@ class TestDatabase(unittest.TestCase):
         self.assertIsInstance(result_id, int)
         self.assertGreater(result_id, 0)
     
+    def test_batch_result_saving(self):
+        """Test saving a batch of OMR results in one transaction"""
+        batch = [
+            OMRResult(
+                filename=f"test_{i}.jpg",
+                sheet_version="A",
+                total_questions=100,
+                correct_answers=80 + i,
+                percentage=80.0 + i,
+                subject_scores='{}',
+                detailed_results='{}',
+                processing_info='{}'
+            )
+            for i in range(5)
+        ]
+        
+        saved = self.db.save_results(batch)
+        self.assertEqual(saved, len(batch))
+        self.assertEqual(self.db.get_database_stats()['total_results'], len(batch))
+    
+    def test_summary_stats(self):
+        """Test SQL-side score aggregation"""
+        # Inserted in one transaction rather than one autocommit per row
+        self.db.save_results([
+            OMRResult(
+                filename=f"stats_{i}.jpg",
+                sheet_version="A",
+                total_questions=100,
+                correct_answers=int(percentage),
+                percentage=percentage,
+                subject_scores='{}',
+                detailed_results='{}',
+                processing_info='{}'
+            )
+            for i, percentage in enumerate([40.0, 55.0, 72.0, 95.0])
+        ])
+        
+        stats = self.db.get_summary_stats()
+        self.assertEqual(stats['total_sheets'], 4)
+        self.assertAlmostEqual(stats['average_score'], 65.5)
+        self.assertEqual(stats['median_score'], 72.0)
+        self.assertEqual(stats['distribution']['Below 50%'], 1)
+        self.assertEqual(stats['distribution']['90-100%'], 1)
+    
+    def test_csv_export_failure_raises(self):
+        """Test that a database error during CSV export is raised, not a truncated CSV"""
+        db = Database(":memory:")
+        db.close()
+        
+        with self.assertRaises(sqlite3.ProgrammingError):
+            export_results_to_csv(db)
+    
     def test_answer_key_storage(self):
         """Test answer key storage and retrieval"""
         test_key = {1: 0, 2: 1, 3: 2}
@@ -136,24 +334,59 @@ class TestDatabase(unittest.TestCase):
         
         retrieved_key = self.db.get_answer_key(version)
         self.assertEqual(retrieved_key, test_key)
+    
+    def test_large_answer_key_storage(self):
+        """Test that a realistic-size answer key round-trips intact"""
+        test_key = _answer_key(1000)
+        
+        success = self.db.save_answer_key("large_version", test_key)
+        self.assertTrue(success)
+        
+        retrieved_key = self.db.get_answer_key("large_version")
+        self.assertEqual(retrieved_key, test_key)
 
 class TestUtilities(unittest.TestCase):
     """Test utility functions"""
     
     def test_image_enhancement(self):
         """Test image enhancement functionality"""
-        # Create test image with noise
-        test_image = np.random.randint(0, 255, (400, 600), dtype=np.uint8)
+        # Shared noise image
+        test_image = _NOISE_400x600
         
         enhanced = enhance_image_quality(test_image)
         
         self.assertIsNotNone(enhanced)
         self.assertEqual(enhanced.shape, test_image.shape)
     
+    def test_nlm_enhancement(self):
+        """Test NLM denoising, through the OpenCL T-API path when a device is present"""
+        test_image = _NOISE_400x600
+        
+        enhanced = enhance_image_quality(test_image, denoise="nlm")
+        
+        # The UMat path must hand back a plain array, same as the CPU path
+        self.assertIsInstance(enhanced, np.ndarray)
+        self.assertEqual(enhanced.shape, test_image.shape)
+        self.assertEqual(enhanced.dtype, np.uint8)
+    
+    def test_unknown_denoise_method(self):
+        """Test that an unknown denoise method is reported, not swallowed"""
+        with self.assertRaises(ValueError):
+            enhance_image_quality(_NOISE_400x600, denoise="median")
+    
+    def test_fast_mode_binarization(self):
+        """Test single-pass binarization path"""
+        test_image = _NOISE_400x600x3
+        
+        binary = enhance_image_quality(test_image, fast_mode=True)
+        
+        self.assertEqual(binary.shape, test_image.shape[:2])
+        self.assertTrue(set(np.unique(binary)) <= {0, 255})
+    
     def test_skew_correction(self):
         """Test skew correction"""
         # Create test image
-        test_image = np.ones((400, 600, 3), dtype=np.uint8) * 255
+        test_image = np.full((400, 600, 3), 255, dtype=np.uint8)
         
         # Add some lines for skew detection
         cv2.line(test_image, (0, 100), (600, 120), (0, 0, 0), 2)
@@ -164,38 +397,37 @@ class TestUtilities(unittest.TestCase):
         self.assertIsNotNone(corrected)
         self.assertIsInstance(angle, float)
     
-    def test_config_loading(self):
+    @patch("utils.open", new_callable=mock_open, create=True)
+    @patch("utils.os.path.exists", return_value=False)
+    def test_config_loading(self, mock_exists, mocked_open):
         """Test configuration loading"""
         from utils import load_config
         
+        # The missing-file path is taken without touching the filesystem
         config = load_config("non_existent_config.json")
         
         # Should return default config
         self.assertIsInstance(config, dict)
         self.assertIn('bubble_threshold', config)
+        mock_exists.assert_called_once_with("non_existent_config.json")
+        mocked_open.assert_called_once_with("non_existent_config.json", 'w')
 
 class TestIntegration(unittest.TestCase):
     """Integration tests for complete workflow"""
     
-    def setUp(self):
+    @classmethod
+    def setUpClass(cls):
         """Set up integration test environment"""
-        self.processor = OMRProcessor()
-        self.db = Database(":memory:")
+        cls.processor = OMRProcessor()
+        cls.db = Database(":memory:")
+        cls.answer_key = _answer_key(10)  # Small test
+        # Convert the synthetic sheet to bytes once for every workflow test
+        cls._omr_buffer = memoryview(cv2.imencode('.jpg', cls.create_synthetic_omr(), FAST_JPEG_PARAMS)[1])
     
     def test_complete_workflow(self):
         """Test complete OMR processing workflow"""
-        # Create synthetic OMR sheet
-        omr_image = self.create_synthetic_omr()
-        
-        # Create answer key
-        answer_key = create_sample_answer_key(10)  # Small test
-        
-        # Convert image to bytes
-        _, buffer = cv2.imencode('.jpg', omr_image)
-        image_bytes = buffer.tobytes()
-        
-        # Process the image
-        results = self.processor.process_omr_sheet(image_bytes, answer_key)
+        # Process the pre-encoded synthetic sheet
+        results = self.processor.process_omr_sheet(self._omr_buffer, self.answer_key)
         
         # Check results
         if 'error' not in results:
@@ -207,35 +439,42 @@ class TestIntegration(unittest.TestCase):
             # Processing may fail with synthetic image, which is acceptable
             self.assertIn('error', results)
     
-    def create_synthetic_omr(self) -> np.ndarray:
+    @staticmethod
+    def create_synthetic_omr() -> np.ndarray:
         """Create a synthetic OMR sheet for testing"""
         # Create white background
-        image = np.ones((800, 600, 3), dtype=np.uint8) * 255
+        image = np.full((800, 600, 3), 255, dtype=np.uint8)
         
         # Add border
         cv2.rectangle(image, (50, 50), (550, 750), (0, 0, 0), 3)
         
-        # Add some bubbles in grid pattern
-        for row in range(10):
-            y = 100 + row * 60
-            for col in range(5):
-                x = 100 + col * 80
-                # Draw circle
-                cv2.circle(image, (x, y), 12, (0, 0, 0), 2)
-                # Randomly fill some bubbles
-                if np.random.random() > 0.7:
-                    cv2.circle(image, (x, y), 10, (0, 0, 0), -1)
+        # Bubble and fill stamps, drawn once on a small tile
+        half = 14
+        tile = np.zeros((2 * half + 1, 2 * half + 1), dtype=np.uint8)
+        ring_tile = cv2.circle(tile.copy(), (half, half), 12, 1, 2)
+        filled_tile = cv2.circle(tile.copy(), (half, half), 10, 1, -1)
+        
+        # Add some bubbles in grid pattern, randomly filling some of them
+        ys, xs = np.meshgrid(100 + np.arange(10) * 60, 100 + np.arange(5) * 80, indexing='ij')
+        fill = _RNG.random(ys.shape) > 0.7
+        for stamp, mask in ((ring_tile, np.ones_like(fill)), (filled_tile, fill)):
+            dy, dx = np.nonzero(stamp)
+            image[ys[mask][:, None] + dy - half, xs[mask][:, None] + dx - half] = 0
         
         return image
 
 # Test runner
+def _run_test_class(class_name: str):
+    """Run one TestCase class by name and return its output and counts"""
+    stream = io.StringIO()
+    tests = unittest.TestLoader().loadTestsFromTestCase(globals()[class_name])
+    result = unittest.TextTestRunner(stream=stream, verbosity=2).run(tests)
+    return stream.getvalue(), result.testsRun, len(result.failures), len(result.errors)
+
 def run_tests():
-    """Run all tests"""
+    """Run all tests, one process per independent TestCase class"""
     print("🧪 Running OMR System Tests...")
     
-    # Create test suite
-    test_suite = unittest.TestSuite()
-    
     # Add test cases
     test_classes = [
         TestOMRProcessor,
@@ -244,21 +483,24 @@ def run_tests():
         TestIntegration
     ]
     
-    for test_class in test_classes:
-        tests = unittest.TestLoader().loadTestsFromTestCase(test_class)
-        test_suite.addTests(tests)
-    
     # Run tests
-    runner = unittest.TextTestRunner(verbosity=2)
-    result = runner.run(test_suite)
+    with ProcessPoolExecutor(max_workers=len(test_classes)) as executor:
+        outcomes = list(executor.map(_run_test_class, [c.__name__ for c in test_classes]))
+    
+    tests_run = failures = errors = 0
+    for output, run, failed, errored in outcomes:
+        print(output, end="")
+        tests_run += run
+        failures += failed
+        errors += errored
     
     # Print summary
     print(f"\\n📊 Test Results:")
-    print(f"✅ Tests passed: {result.testsRun - len(result.failures) - len(result.errors)}")
-    print(f"❌ Tests failed: {len(result.failures)}")
-    print(f"💥 Errors: {len(result.errors)}")
+    print(f"✅ Tests passed: {tests_run - failures - errors}")
+    print(f"❌ Tests failed: {failures}")
+    print(f"💥 Errors: {errors}")
     
-    return result.wasSuccessful()
+    return failures == 0 and errors == 0
 
 if __name__ == '__main__':
     run_tests()
\ No newline at end of file